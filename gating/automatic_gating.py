@@ -2,7 +2,7 @@ import itertools
 import numpy as np
 from loguru import logger
 
-from gating.signal_processing import identify_extrema
+from gating.signal_processing import identify_extrema, identify_maxima
 from gui.popup_windows.frame_range_dialog import StartFramesDialog
 
 
@@ -33,7 +33,7 @@ class AutomaticGating:
         if dialog.exec_():
             if self.maxima_only:
                 logger.info('Maxima peak detection according to config.yaml')
-                maxima_indices = identify_extrema(self.main_window, image_based_signal)[1]
+                maxima_indices = identify_maxima(self.main_window, image_based_signal)
                 extrema_indices = list(identify_extrema(self.main_window, contour_based_signal)[0])
             else:
                 logger.info('Extrema peak detection according to config.yaml')
@@ -52,21 +52,7 @@ class AutomaticGating:
                 if systolic_start is None or diastolic_start is None:
                     # if systolic_start or diastolic_start is not defined, find the first and second maxima indices and extrema indices that are not further then 5 frames apart
                     # starting from the last index in both lists
-                    found_first = False  # To track the first occurrence for diastole
-                    # Loop from the end of maxima_indices and extrema_indices to find close pairs
-                    for max_idx in reversed(maxima_indices):
-                        for ext_idx in reversed(extrema_indices):
-                            # Check if indices are within 5 frames of each other
-                            if abs(max_idx - ext_idx) <= 5:
-                                # Set diastolic_start to the first occurrence, and systolic_start to the second
-                                if not found_first:
-                                    diastolic_start = (max_idx + ext_idx) // 2
-                                    found_first = True  # Mark that we've found the first occurrence
-                                else:
-                                    systolic_start = (max_idx + ext_idx) // 2
-                                    break  # Exit once both are found
-                        if systolic_start is not None and diastolic_start is not None:
-                            break
+                    systolic_start, diastolic_start = self.find_start_frames(maxima_indices, extrema_indices)
 
                 # Log the selected start frames
                 logger.info(f"Systolic start frame: {systolic_start}, Diastolic start frame: {diastolic_start}")
@@ -109,18 +95,9 @@ class AutomaticGating:
             first_half = gated_indices[::2]
             second_half = gated_indices[1::2]
 
-            sum_first_half = sum(
-                [
-                    self.report_data.loc[self.report_data['frame'] == frame, 'lumen_area'].values[0]
-                    for frame in first_half
-                ]
-            )
-            sum_second_half = sum(
-                [
-                    self.report_data.loc[self.report_data['frame'] == frame, 'lumen_area'].values[0]
-                    for frame in second_half
-                ]
-            )
+            area_by_frame = dict(zip(self.report_data['frame'].values, self.report_data['lumen_area'].values))
+            sum_first_half = sum(area_by_frame[frame] for frame in first_half)
+            sum_second_half = sum(area_by_frame[frame] for frame in second_half)
 
             # reset all phases
             self.main_window.data['phases'] == '-'
@@ -145,6 +122,28 @@ class AutomaticGating:
             for frame in self.main_window.gated_frames_sys:
                 self.main_window.data['phases'][frame] = 'S'
 
+    def find_start_frames(self, maxima_indices, extrema_indices, max_distance=5):
+        """
+        Finds the last two pairs of maxima and extrema indices that are at most max_distance frames apart,
+        walking both sorted index lists backwards with two pointers instead of comparing every pair.
+        The midpoint of the last pair is used as diastolic start frame, the one of the second last as systolic.
+        """
+        close_pairs = []
+        ext_pointer = len(extrema_indices) - 1
+        for max_idx in reversed(maxima_indices):
+            # skip extrema too far after the current maximum, these are also too far after all earlier maxima
+            while ext_pointer >= 0 and extrema_indices[ext_pointer] > max_idx + max_distance:
+                ext_pointer -= 1
+            candidate = ext_pointer
+            while candidate >= 0 and extrema_indices[candidate] >= max_idx - max_distance:
+                close_pairs.append((max_idx + extrema_indices[candidate]) // 2)
+                if len(close_pairs) == 2:
+                    return close_pairs[1], close_pairs[0]
+                candidate -= 1
+
+        diastolic_start = close_pairs[0] if close_pairs else None
+        return None, diastolic_start
+
     def propagate_gated_frames(self, starting_frame, heart_rate, maxima_indices, extrema_indices):
         propagated_indices = []
         counter = 0
@@ -1,5 +1,4 @@
 import warnings
-import time
 import itertools
 import numpy as np
 from matplotlib.backend_bases import MouseButton
@@ -14,16 +13,8 @@ from gui.popup_windows.frame_range_dialog import FrameRangeDialog, StartFramesDi
 from gui.right_half.right_half import toggle_diastolic_frame, toggle_systolic_frame
 from report.report import report
 
-
-def timing_decorator(func):
-    def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        print(f"{func.__name__} took {end_time - start_time:.4f} seconds")
-        return result
-
-    return wrapper
+# tight_layout cannot always be applied to the gating display, this is harmless
+warnings.filterwarnings('ignore', message='.*tight.?layout', category=UserWarning)
 
 
 class ContourBasedGating:
@@ -124,14 +115,8 @@ class ContourBasedGating:
         self.draw_existing_lines(self.main_window.gated_frames_sys, self.main_window.systole_color_plt)
 
         # Layout and rendering
-        with warnings.catch_warnings(record=True) as caught_warnings:
-            warnings.simplefilter("always")
-            plt.tight_layout()
-
-            if any("tight_layout" in str(w.message) for w in caught_warnings):
-                plt.draw()
-            else:
-                plt.draw()
+        plt.tight_layout()
+        plt.draw()
 
         return True
 
@@ -215,9 +200,13 @@ class ContourBasedGating:
         plt.draw()
 
     def draw_existing_lines(self, frames, color):
-        frames = [frame for frame in frames if frame in (self.x - 1)]  # remove frames outside of user-defined range
-        for frame in frames:
-            self.vertical_lines.append(plt.axvline(x=frame + 1, color=color, linestyle=self.default_linestyle))
+        # remove frames outside of user-defined range
+        frames = np.asarray(frames, dtype=int)
+        frames = frames[np.isin(frames, self.x - 1)]
+        # one artist per line is kept since lines are selected, dragged and removed individually
+        self.vertical_lines.extend(
+            self.ax.axvline(x=frame + 1, color=color, linestyle=self.default_linestyle) for frame in frames
+        )
 
     def remove_lines(self):
         for line in self.vertical_lines:
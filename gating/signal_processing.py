@@ -1,16 +1,30 @@
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
 import numpy as np
 from loguru import logger
-from scipy.signal import find_peaks, butter, filtfilt
+from scipy.fft import rfftn
+from scipy.signal import find_peaks, butter, sosfiltfilt
 import cv2
 
+torch = None  # imported by gpu_available only if the GPU is enabled, importing it slows down the start of the GUI
+
+
+DEBUG_TIMING = os.environ.get('NIVA_PROFILE') == '1'
+
 
 def timing_decorator(func):
+    """Logs the runtime of func if the NIVA_PROFILE environment variable is set to 1, otherwise returns func as is"""
+    if not DEBUG_TIMING:
+        return func
+
+    @wraps(func)
     def wrapper(*args, **kwargs):
-        start_time = time.time()
+        start_time = time.perf_counter_ns()
         result = func(*args, **kwargs)
-        end_time = time.time()
-        print(f"{func.__name__} took {end_time - start_time:.4f} seconds")
+        end_time = time.perf_counter_ns()
+        logger.debug(f"{func.__name__} took {(end_time - start_time) / 1e9:.4f} seconds")
         return result
 
     return wrapper
@@ -38,25 +52,25 @@ def prepare_data(main_window, frames, report_data, x1=50, x2=450, y1=50, y2=450)
     # Initialize variables
     step = main_window.config.gating.normalize_step
     maxima_only = main_window.config.gating.maxima_only
-    # Crop frames to a specific region
+    use_gpu = main_window.config.gpu.gating and gpu_available()
+    # Crop frames to a specific region, a view on the original images (the kernels convert one chunk at a time to
+    # single precision, which is sufficient for correlation and blurring)
     frames = frames[:, x1:x2, y1:y2]
 
     # Normalize signals
-    correlation = normalize_data(calculate_correlation(frames), step)
-    blurring = normalize_data(calculate_blurring_fft(frames), step)
+    correlation, blurring = calculate_image_signals(frames, use_gpu)
+    correlation = normalize_data(correlation, step)
+    blurring = normalize_data(blurring, step)
     shortest_dist = normalize_data(report_data['shortest_distance'], step)
     vector_angle = normalize_data(report_data['vector_angle'], step)
     vector_length = normalize_data(report_data['vector_length'], step)
 
-    signal_image_based_filtered = [
-        bandpass_filter(main_window, correlation),
-        bandpass_filter(main_window, blurring),
-    ]
-    signal_contour_based_filtered = [
-        bandpass_filter(main_window, shortest_dist),
-        bandpass_filter(main_window, vector_angle),
-        bandpass_filter(main_window, vector_length),
-    ]
+    # Filter all signals in one call, rows: correlation, blurring, shortest distance, vector angle, vector length
+    filtered = bandpass_filter(
+        main_window, np.vstack([correlation, blurring, shortest_dist, vector_angle, vector_length])
+    )
+    signal_image_based_filtered = list(filtered[:2])
+    signal_contour_based_filtered = list(filtered[2:])
     image_based_gating = combined_signal(main_window, [correlation, blurring], maxima_only=maxima_only)
     image_based_gating_filtered = combined_signal(main_window, signal_image_based_filtered, maxima_only=maxima_only)
     contour_based_gating = combined_signal(main_window, [shortest_dist, vector_angle, vector_length], maxima_only=False)
@@ -75,48 +89,113 @@ def prepare_data(main_window, frames, report_data, x1=50, x2=450, y1=50, y2=450)
 
 def normalize_data(data, step):
     # z-score normalization either for full set, or defined steps
+    data = np.asarray(data, dtype=np.float64)
     if step == 0:
-        return (data - np.mean(data)) / np.std(data)
-    else:
-        normalized_data = np.zeros_like(data)
+        step = len(data)
+    normalized_data = np.empty_like(data)
+
+    for i in range(0, len(data), step):
+        # centre directly into the output buffer and reuse it for the standard deviation
+        segment_normalized = normalized_data[i : i + step]
+        np.subtract(data[i : i + step], np.mean(data[i : i + step]), out=segment_normalized)
+        std = np.sqrt(np.dot(segment_normalized, segment_normalized) / len(segment_normalized))
+        segment_normalized /= std or 1.0  # constant segments stay zero instead of turning into NaN
+
+    return normalized_data
+
+
+def calculate_image_signals(frames, use_gpu=False):
+    """
+    Calculates correlation and blurring of the frames. If the GPU runs out of memory or fails otherwise, both are
+    calculated on the CPU instead.
+    """
+    if use_gpu:
+        try:
+            return _image_signals(frames, True)
+        except RuntimeError as error:  # also covers torch.cuda.OutOfMemoryError
+            logger.warning(f"Gating on the GPU failed, falling back to the CPU: {error}")
+            torch.cuda.empty_cache()
+    return _image_signals(frames, False)
+
 
-        for i in range(0, len(data), step):
-            segment = data[i : i + step]
+def _image_signals(frames, use_gpu):
+    # Correlation and blurring are independent and spend their time in compiled code releasing the GIL
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        correlation = executor.submit(calculate_correlation, frames, use_gpu)
+        blurring = executor.submit(calculate_blurring_fft, frames, use_gpu)
+        return correlation.result(), blurring.result()
 
-            segment_normalized = (segment - np.mean(segment)) / np.std(segment)
 
-            normalized_data[i : i + step] = segment_normalized
+def gpu_available():
+    global torch
+    try:
+        import torch
+    except ImportError:  # gating signals are computed with NumPy/SciPy only
+        return False
+    return torch.cuda.is_available()
+
 
-        return normalized_data
+def to_gpu(array):
+    return torch.from_numpy(np.ascontiguousarray(array, dtype=np.float32)).to('cuda')
 
 
 @timing_decorator
-def calculate_correlation(frames):
+def calculate_correlation(frames, use_gpu=False, chunk_size=100):
     """Calculates correlation coefficients between consecutive frames."""
-    correlations = []
-    for i in range(len(frames) - 1):
-        corr = np.corrcoef(frames[i].ravel(), frames[i + 1].ravel())[0, 1]
-        correlations.append(corr)
-    correlations.append(0)  # to match the length of the frames
+    # Pearson correlation of all consecutive pairs at once: after centring and scaling every flattened frame to
+    # unit length, the correlation of two frames is the dot product of their rows (only the first super-diagonal
+    # of the Gram matrix is needed, so the full frames @ frames.T product is not computed)
+    correlations = np.zeros(len(frames))  # the last entry stays 0 to match the length of the frames
+    previous = None  # last centred frame of the previous chunk, paired with the first frame of the next one
+
+    # Centre frames in chunks to bound the memory used by the centred copies, as for the blurring FFT
+    for start in range(0, len(frames), chunk_size):
+        chunk = frames[start : start + chunk_size]
+        end = start + len(chunk) - 1
+        if use_gpu:
+            chunk = to_gpu(chunk).reshape(len(chunk), -1)  # only one chunk at a time is held on the device
+            centered = chunk - chunk.mean(dim=1, keepdim=True)
+            centered /= torch.linalg.vector_norm(centered, dim=1, keepdim=True)
+            correlations[start:end] = (centered[:-1] * centered[1:]).sum(dim=1).cpu().numpy()
+        else:
+            chunk = np.ascontiguousarray(chunk, dtype=np.float32).reshape(len(chunk), -1)
+            centered = chunk - chunk.mean(axis=1, keepdims=True)
+            centered /= np.sqrt(np.einsum('ij,ij->i', centered, centered))[:, None]
+            correlations[start:end] = np.einsum('ij,ij->i', centered[:-1], centered[1:])
+        if previous is not None:
+            correlations[start - 1] = float((previous * centered[0]).sum())
+        previous = centered[-1].clone() if use_gpu else centered[-1].copy()  # the chunk's copy is released
 
     return correlations
 
 
 @timing_decorator
-def calculate_blurring_fft(frames):
+def calculate_blurring_fft(frames, use_gpu=False, chunk_size=100):
     """Calculates blurring using Fast Fourier Transform. Takes the average of the 10% highest frequencies."""
-    blurring_scores = []
-    for frame in frames:
-        fft_data = np.fft.fft2(frame)
-        fft_shifted = np.fft.fftshift(fft_data)
-        magnitude_spectrum = np.abs(fft_shifted)
-
-        # Use np.partition to get the 10% highest frequencies
-        n = len(magnitude_spectrum.ravel())
-        threshold_index = int(0.9 * n)
-        highest_frequencies = np.partition(magnitude_spectrum.ravel(), threshold_index)[threshold_index:]
-        blurring_score = np.mean(highest_frequencies)
-        blurring_scores.append(blurring_score)
+    width = frames.shape[2]
+    n = frames.shape[1] * width
+    threshold_index = int(0.9 * n)
+    mirrored_columns = slice(1, (width - 1) // 2 + 1)  # columns whose conjugates are omitted by the real FFT
+    blurring_scores = np.empty(len(frames))
+
+    # Transform frames in chunks to bound the memory used by the spectra. No fftshift needed, the 10% highest
+    # magnitudes do not depend on where the zero frequency is located
+    for start in range(0, len(frames), chunk_size):
+        chunk = frames[start : start + chunk_size]
+        # Frames are real, so the spectrum is Hermitian and the real FFT holds every magnitude of the full spectrum
+        if use_gpu:
+            chunk = to_gpu(chunk)
+            half_spectrum = torch.fft.rfftn(chunk, dim=(-2, -1)).abs()
+            magnitude_spectrum = torch.cat((half_spectrum, half_spectrum[:, :, mirrored_columns]), dim=-1)
+            highest_frequencies = torch.topk(magnitude_spectrum.reshape(len(chunk), -1), n - threshold_index).values
+            blurring_scores[start : start + chunk_size] = highest_frequencies.mean(dim=1).cpu().numpy()
+        else:
+            half_spectrum = np.abs(rfftn(np.asarray(chunk, dtype=np.float32), axes=(-2, -1), workers=-1))
+            magnitude_spectrum = np.concatenate(
+                (half_spectrum, half_spectrum[:, :, mirrored_columns]), axis=-1
+            ).reshape(len(chunk), -1)
+            magnitude_spectrum.partition(threshold_index, axis=1)  # in place, the spectrum is a temporary copy anyway
+            blurring_scores[start : start + chunk_size] = np.mean(magnitude_spectrum[:, threshold_index:], axis=1)
 
     return blurring_scores
     # blurring_scores = []
@@ -139,7 +218,7 @@ def bandpass_filter(main_window, signal):
     Applies a Butterworth bandpass filter to the input signal using instance parameters.
 
     Parameters:
-    - signal (array-like): The input signal to filter.
+    - signal (array-like): The input signal to filter, 2D input is filtered row by row.
 
     Returns:
     - filtered_signal (numpy.ndarray): The bandpass filtered signal.
@@ -149,17 +228,22 @@ def bandpass_filter(main_window, signal):
     order = main_window.config.gating.order
     fs = main_window.metadata['frame_rate']  # for Butterworth filter
 
+    sos = butter_bandpass_sos(lowcut, highcut, order, fs)
+
+    # Apply filter using sosfiltfilt for zero phase distortion
+    filtered_signal = sosfiltfilt(sos, signal, axis=-1)
+
+    return filtered_signal
+
+
+@lru_cache(maxsize=8)
+def butter_bandpass_sos(lowcut, highcut, order, fs):
+    """Designs a Butterworth bandpass filter in second-order sections, cached since parameters rarely change."""
     nyquist = 0.5 * fs
     low = lowcut / nyquist
     high = highcut / nyquist
 
-    # Design Butterworth bandpass filter
-    b, a = butter(order, [low, high], btype='band')
-
-    # Apply filter using filtfilt for zero phase distortion
-    filtered_signal = filtfilt(b, a, signal)
-
-    return filtered_signal
+    return butter(order, [low, high], btype='band', output='sos')
 
 
 def combined_signal(
@@ -182,7 +266,7 @@ def combined_signal(
     extrema_indices = []
     for signal in signal_list:
         if maxima_only:
-            extrema_indices.append(identify_extrema(main_window, signal)[1][::2])
+            extrema_indices.append(identify_maxima(main_window, signal)[::2])
         else:
             extrema_indices.append(identify_extrema(main_window, signal)[0][::2])
 
@@ -194,8 +278,9 @@ def combined_signal(
     # calculate sum of all variabilities and then create a combined signal with weights as percent of variability
     # sum_variability = np.sum(variability)
     # weights = [(var / sum_variability) ** -1 for var in variability]
-    inverse_variability = [(1 / var) for var in variability]
-    weights = [inv_var / sum(inverse_variability) for inv_var in inverse_variability]
+    # perfectly regular extrema (zero variability) get the largest finite weight instead of a division by zero
+    inverse_variability = 1 / np.maximum(variability, np.finfo(float).eps)
+    weights = inverse_variability / np.sum(inverse_variability)
 
 
     # print the chosen weights per variable
@@ -204,22 +289,14 @@ def combined_signal(
     elif len(signal_list) == 2:
         logger.info(f"Signal weights: Correlation: {weights[0]:.2f}, Blurring: {weights[1]:.2f}")
 
-    combined_signal = np.zeros(len(signal_list[0]))
-    for i, signal in enumerate(signal_list):
-        combined_signal += weights[i] * signal
+    combined_signal = weights @ np.vstack(signal_list)
 
     return combined_signal
 
 
 def identify_extrema(main_window, signal):
-    extrema_y_lim = main_window.config.gating.extrema_y_lim
     extrema_x_lim = main_window.config.gating.extrema_x_lim
-
-    # Remove NaN and infinite values from the signal
-    signal = np.nan_to_num(signal, nan=0.0, posinf=0.0, neginf=0.0)
-
-    # Dynamically calculate prominence based on the signal's characteristics
-    min_height = np.percentile(signal, extrema_y_lim)  # Only consider peaks above the median
+    signal, min_height = prepare_peak_search(main_window, signal)
 
     # Find maxima and minima using find_peaks with dynamic prominence
     maxima_indices, _ = find_peaks(signal, distance=extrema_x_lim, height=min_height)
@@ -230,3 +307,23 @@ def identify_extrema(main_window, signal):
     extrema_indices = np.sort(extrema_indices)
 
     return extrema_indices, maxima_indices
+
+
+def identify_maxima(main_window, signal):
+    """Same maxima as identify_extrema, for callers that do not need the minima (skips their search)"""
+    signal, min_height = prepare_peak_search(main_window, signal)
+    maxima_indices, _ = find_peaks(signal, distance=main_window.config.gating.extrema_x_lim, height=min_height)
+
+    return maxima_indices
+
+
+def prepare_peak_search(main_window, signal):
+    extrema_y_lim = main_window.config.gating.extrema_y_lim
+
+    # Remove NaN and infinite values from the signal
+    signal = np.nan_to_num(signal, nan=0.0, posinf=0.0, neginf=0.0)
+
+    # Dynamically calculate prominence based on the signal's characteristics
+    min_height = np.percentile(signal, extrema_y_lim)  # Only consider peaks above the median
+
+    return signal, min_height
@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import numpy as np
 import SimpleITK as sitk
@@ -17,27 +18,25 @@ def save_as_nifti(main_window, mode=None):
         return
 
     out_path = os.path.join(main_window.config.save.nifti_dir, f'{mode}_frames')
+    num_frames = main_window.metadata['num_frames']
+    has_lumen = np.array([bool(contour) for contour in main_window.data['lumen'][0][:num_frames]], dtype=bool)
     if mode == 'contoured':
-        frames_to_save = [
-            frame for frame in range(main_window.metadata['num_frames']) if main_window.data['lumen'][0][frame]
-        ]
+        frames_to_save = np.flatnonzero(has_lumen)
     elif mode == 'gated':
-        frames_to_save = [
-            frame
-            for frame in range(main_window.metadata['num_frames'])
-            if main_window.data['lumen'][0][frame] and main_window.data['phases'][frame] in ['D', 'S']
-        ]
+        is_gated = np.isin(np.asarray(main_window.data['phases'][:num_frames]), ['D', 'S'])
+        frames_to_save = np.flatnonzero(has_lumen & is_gated)
     elif mode == 'all':
-        frames_to_save = range(main_window.metadata['num_frames'])
+        frames_to_save = np.arange(num_frames)
     else:
         return  # nothing to save
 
-    if frames_to_save:
+    if len(frames_to_save):
         main_window.status_bar.showMessage('Saving frames as NIfTi files...')
         file_name = os.path.splitext(os.path.basename(main_window.file_name))[0]  # remove file extension
         os.makedirs(out_path, exist_ok=True)
-        mask = contours_to_mask(main_window.images[frames_to_save], frames_to_save, main_window.display.full_contours)
 
+        # the modal dialog is shown before any worker starts, so contours cannot be edited and no other file can be
+        # loaded or saved while the workers read them
         progress = QProgressDialog()
         progress.setWindowFlags(Qt.Dialog)
         progress.setModal(True)
@@ -47,36 +46,75 @@ def save_as_nifti(main_window, mode=None):
         progress.resize(500, 100)
         progress.setWindowTitle('Saving frames as NIfTi files...')
         progress.show()
+        QApplication.processEvents()
 
-        if main_window.config.save.save_2d:
-            for i, frame in enumerate(frames_to_save):  # save individual frames as NIfTi
-                progress.setValue(i)
-                QApplication.processEvents()
-                if progress.wasCanceled():
-                    break
-                if main_window.data['lumen'][0][frame]:  # only save mask if contour exists
-                    sitk.WriteImage(
-                        sitk.GetImageFromArray(mask[i, :, :]),
-                        os.path.join(out_path, f'{file_name}_frame_{frame}_seg.nii.gz'),
+        # mask creation and writing run in worker threads, the GUI keeps processing events in the meantime
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            (mask,) = wait_processing_events(
+                [
+                    executor.submit(
+                        contours_to_mask,
+                        main_window.images[frames_to_save],
+                        frames_to_save,
+                        main_window.display.full_contours,
                     )
-                sitk.WriteImage(
-                    sitk.GetImageFromArray(main_window.images[frame, :, :]),
-                    os.path.join(out_path, f'{file_name}_frame_{frame}_img.nii.gz'),
-                )
-        if main_window.config.save.save_3d:
-            if any(main_window.data['lumen'][0]):  # only save mask if any contour exists
-                sitk.WriteImage(sitk.GetImageFromArray(mask), os.path.join(out_path, f'{file_name}_seg.nii.gz'))
-            sitk.WriteImage(
-                sitk.GetImageFromArray(main_window.images[frames_to_save]),
-                os.path.join(out_path, f'{file_name}_img.nii.gz'),
+                ]
             )
-            progress.setValue(len(frames_to_save) * main_window.config.save.save_2d + 1)
-            QApplication.processEvents()
+
+            if main_window.config.save.save_2d:
+                for i, frame in enumerate(frames_to_save):  # save individual frames as NIfTi
+                    progress.setValue(i)
+                    QApplication.processEvents()
+                    if progress.wasCanceled():
+                        break
+                    futures = [
+                        executor.submit(
+                            write_nifti,
+                            main_window.images[frame, :, :],
+                            os.path.join(out_path, f'{file_name}_frame_{frame}_img.nii.gz'),
+                        )
+                    ]
+                    if has_lumen[frame]:  # only save mask if contour exists
+                        futures.append(
+                            executor.submit(
+                                write_nifti,
+                                mask[i, :, :],
+                                os.path.join(out_path, f'{file_name}_frame_{frame}_seg.nii.gz'),
+                            )
+                        )
+                    wait_processing_events(futures)
+            if main_window.config.save.save_3d:
+                futures = [
+                    executor.submit(
+                        write_nifti,
+                        main_window.images[frames_to_save],
+                        os.path.join(out_path, f'{file_name}_img.nii.gz'),
+                    )
+                ]
+                if has_lumen.any():  # only save mask if any contour exists
+                    futures.append(
+                        executor.submit(write_nifti, mask, os.path.join(out_path, f'{file_name}_seg.nii.gz'))
+                    )
+                wait_processing_events(futures)
+                progress.setValue(len(frames_to_save) * main_window.config.save.save_2d + 1)
+                QApplication.processEvents()
 
         progress.close()
         main_window.status_bar.showMessage(main_window.waiting_status)
 
 
+def write_nifti(array, file_path):
+    sitk.WriteImage(sitk.GetImageFromArray(array), file_path)
+
+
+def wait_processing_events(futures, interval=0.05):
+    """Waits for all futures to finish while keeping the GUI responsive, returns their results in order"""
+    while wait(futures, timeout=interval).not_done:
+        QApplication.processEvents()
+
+    return [future.result() for future in futures]
+
+
 def contours_to_mask(images, contoured_frames, contours):
     """Convert IVUS contours to numpy mask"""
     image_shape = images.shape[1:3]
@@ -13,6 +13,10 @@ ds_test_path = join(BASE_DIR, "imagesTs")
 ds_test_seg_path = join(BASE_DIR, "labelsTs")
 ds_val_path = join(BASE_DIR, "imagesVal")
 ds_val_seg_path = join(BASE_DIR, "labelsVal")
+# decoded volumes are cached here as memory-mapped .npy files, set to None to always read the NIfTI files
+ds_train_cache_path = join(BASE_DIR, "cache", "train")
+ds_test_cache_path = join(BASE_DIR, "cache", "test")
+ds_val_cache_path = join(BASE_DIR, "cache", "val")
 
 
 
@@ -30,6 +34,8 @@ EPOCHS = 250
 IMG_SIZE = (512, 512)
 N_CHANNELS = 1
 BATCH_SIZE = 16
+# consecutive slices of a volume shuffled together in training, larger blocks read the cached volumes sequentially
+SHUFFLE_BLOCK_SIZE = 1
 
 BEST_SUFFIX = "_best"
 LAST_SUFFIX = "_last"
@@ -1,15 +1,17 @@
 import math
+import os
 import random
 from glob import glob
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple, List, Any, Dict
-from joblib import Parallel, delayed
 
 import albumentations as A
+import cv2
 import matplotlib.pyplot as plt
 import nibabel as nib
 import numpy as np
 import tensorflow as tf
-from joblib import Parallel
 from sklearn.model_selection import train_test_split
 
 
@@ -26,6 +28,7 @@ class DataGenerator(tf.keras.utils.Sequence):
                  vertical_flip_p: float = 0.5,
                  horizontal_flip_p: float = 0.5,
                  shuffle=True,
+                 shuffle_block_size: int = 1,
                  hue_p=0.5,
                  contrast_p=0.5,
                  brightness_p=0.5,
@@ -34,28 +37,49 @@ class DataGenerator(tf.keras.utils.Sequence):
                  val_shift_limit: int = 20,
                  contrast_limit: float = 0.2,
                  brightness_limit: float = 0.2,
+                 cache_dir: str = None,
                  ):
         # nfile = glob(data_path + '/NAC/*.nii.gz')
         # train_files, val_files = train_test_split(nfile, test_size=val_size, random_state=seed)
-        img_data, mask_data = reg_data_prep(img_files, mask_files)
-        self.img_paths = np.array(img_data)
-        self.mask_paths = np.array(mask_data)
-        print(img_data.shape, mask_data.shape)
+        if cache_dir is not None:
+            self.img_volumes, self.mask_volumes, self.slice_index = load_cache(img_files, mask_files, cache_dir,
+                                                                              img_size)
+        else:
+            self.img_volumes, self.mask_volumes, self.slice_index = reg_data_prep(img_files, mask_files, img_size)
+        print(f"{len(self.img_volumes)} volumes, {len(self.slice_index)} slices")
+        self.order = np.arange(len(self.slice_index), dtype=np.int64)  # shuffled in place every epoch
+        # blocks of up to shuffle_block_size consecutive slices of a volume are kept together when shuffling, so
+        # memory-mapped volumes are read sequentially within a block (1 shuffles single slices)
+        self.shuffle_block_size = shuffle_block_size
+        if shuffle_block_size > 1:
+            block_starts = np.flatnonzero(self.slice_index[:, 1] % shuffle_block_size == 0)
+            self.blocks = np.split(self.order.copy(), block_starts[1:])
         self.batch_size = batch_size
         self.shuffle = shuffle
         self.augmentation_p = augmentation_p
-        self.transform = A.Compose([
-            A.Rotate(limit=180, p=random_rotate_p),
-            A.VerticalFlip(p=vertical_flip_p),
-            A.HorizontalFlip(p=horizontal_flip_p),
-            # A.CenterCrop(p=p_center_crop, height=img_size[0], width=img_size[1]),
+        # rotation and flips of a sample are combined into one affine warp, see random_affine
+        # A.CenterCrop(p=p_center_crop, height=img_size[0], width=img_size[1]),
+        self.rotate_limit = 180
+        self.random_rotate_p = random_rotate_p
+        self.vertical_flip_p = vertical_flip_p
+        self.horizontal_flip_p = horizontal_flip_p
+        # pixel-level transforms do not move pixels between images, hence they are applied once to the whole batch
+        # stacked along the height (all images of a batch share the sampled parameters). The augmentation gate is
+        # folded into the per-op probability instead of a second draw for the whole Compose
+        self.pixel_transform = A.Compose([
             A.HueSaturationValue(hue_shift_limit=hue_shift_limit,
                                  sat_shift_limit=sat_shift_limit,
                                  val_shift_limit=val_shift_limit,
-                                 p=hue_p),
+                                 p=self.augmentation_p * hue_p),
             # A.RandomContrast(limit=contrast_limit, p=contrast_p),
             # A.RandomBrightness(limit=brightness_limit, p=brightness_p),
-        ], p=self.augmentation_p)
+        ])
+        # HueSaturationValue converts grayscale images to RGB and back and only its value shift applies to them,
+        # hence grayscale images get a lookup table based brightness and contrast change instead
+        self.brightness_p = brightness_p
+        self.contrast_p = contrast_p
+        self.brightness_limit = brightness_limit
+        self.contrast_limit = contrast_limit
         self.img_size = img_size
         self.img_channel = img_channels
         self.mask_channel = mask_channels
@@ -64,59 +88,269 @@ class DataGenerator(tf.keras.utils.Sequence):
         # self.beta = beta
         self.on_epoch_end()
 
+    def to_dataset(self) -> tf.data.Dataset:
+        """
+        Wraps the generator in a tf.data pipeline that builds batches in parallel threads and prefetches them, so
+        loading and augmentation overlap with training. Keras does not call on_epoch_end for datasets, reshuffle
+        with a callback instead.
+        """
+        x_shape = (self.batch_size, *self.img_size, self.img_channel)
+        y_shape = (self.batch_size, *self.img_size, self.mask_channel)
+
+        def load_batch(idx):
+            x, y = tf.numpy_function(self.__getitem__, [idx], [tf.float32, tf.uint8])
+            x.set_shape(x_shape)
+            y.set_shape(y_shape)
+            return x, y
+
+        options = tf.data.Options()
+        options.threading.private_threadpool_size = os.cpu_count()
+        dataset = tf.data.Dataset.range(len(self)).map(load_batch, num_parallel_calls=tf.data.AUTOTUNE)
+        return dataset.with_options(options).prefetch(tf.data.AUTOTUNE)
+
     def on_epoch_end(self):
-        if self.shuffle:
-            indices = np.random.permutation(len(self.img_paths)).astype(np.int32)
-            self.img_paths, self.mask_paths = self.img_paths[indices], self.mask_paths[indices]
+        if not self.shuffle:
+            return
+        if self.shuffle_block_size <= 1:
+            np.random.shuffle(self.order)
+        else:
+            random.shuffle(self.blocks)
+            self.order = np.concatenate(self.blocks)
 
     def __len__(self):
-        return math.ceil(len(self.img_paths) / self.batch_size)
+        return math.ceil(len(self.slice_index) / self.batch_size)
 
     def __getitem__(self, idx):
-        batch_img = self.img_paths[idx * self.batch_size:(idx + 1) * self.batch_size]
-        batch_mask = self.mask_paths[idx * self.batch_size:(idx + 1) * self.batch_size]
-        x = np.zeros((self.batch_size, *self.img_size, self.img_channel), dtype=np.float32)
-        y = np.zeros((self.batch_size, *self.img_size, self.mask_channel), dtype=np.uint8)
+        batch_index = self.slice_index[self.order[idx * self.batch_size:(idx + 1) * self.batch_size]]
+        # slices are only read here, memory-mapped volumes are paged in on demand
+        batch_img = [self.img_volumes[case][z] for case, z in batch_index]
+        batch_mask = [self.mask_volumes[case][z] for case, z in batch_index]
+        # images stay uint8 through augmentation, OpenCV is fastest on uint8 and moves a quarter of the bytes
+        x = np.zeros((self.batch_size, *self.img_size, self.img_channel), dtype=np.uint8)
+        # all mask channels hold the same mask, it is stored once and broadcast on return
+        y = np.zeros((self.batch_size, *self.img_size, 1), dtype=np.uint8)
+        n_samples = len(batch_index)
+        augment = np.random.random(n_samples) < self.augmentation_p
+        dsize = (self.img_size[1], self.img_size[0])
 
-        for i, (img, mask) in enumerate(zip(batch_img, batch_mask)):
-            # img = cv2.resize(img, self.img_size)
-            # mask = cv2.resize(mask, self.img_size, interpolation=cv2.INTER_NEAREST)
+        # the transforms are sampled first, then images and masks are processed in two separate passes
+        matrices = [self.random_affine() if sample_augment else None for sample_augment in augment]
+        for i, (img, matrix) in enumerate(zip(batch_img, matrices)):
+            if matrix is None:
+                x[i] = img
+            else:  # one pass instead of a rotation followed by separate flips
+                x[i] = cv2.warpAffine(img, matrix, dsize, flags=cv2.INTER_LINEAR,
+                                      borderMode=cv2.BORDER_REFLECT_101).reshape(x[i].shape)
+        for i, (mask, matrix) in enumerate(zip(batch_mask, matrices)):
+            if matrix is None:
+                y[i] = mask
+            else:
+                y[i] = cv2.warpAffine(mask, matrix, dsize, flags=cv2.INTER_NEAREST,
+                                      borderMode=cv2.BORDER_REFLECT_101)[..., None]
 
-            augmented = self.transform(image=img.astype(np.float32), mask=mask.astype(np.uint8))
-            img, mask = augmented['image'], augmented['mask']
-            x[i] = img
-            y[i] = mask
+        if self.augmentation_p > 0:  # validation and test batches are only gathered and scaled
+            stacked = x[:n_samples].reshape(-1, self.img_size[1], self.img_channel)
+            if self.img_channel == 1:
+                stacked = self.random_brightness_contrast(stacked)
+            else:
+                stacked = self.pixel_transform(image=stacked)['image']
+            x[:n_samples] = stacked.reshape(x[:n_samples].shape)
 
         # y = y.reshape((self.batch_size, *self.img_size, 1)) / 255  # normalization is done for all the samples
-        y = np.concatenate([y] * self.mask_channel, axis=-1)
-        x = x / 255
-        return x, y
+        # x and y are allocated per call since the tf.data pipeline builds several batches concurrently
+        x = np.multiply(x, np.float32(1 / 255), dtype=np.float32)
+        return x, np.broadcast_to(y, (*y.shape[:-1], self.mask_channel))
+
+    def random_affine(self):
+        """
+        Samples a random rotation and random vertical and horizontal flips of a sample as one 2x3 affine matrix,
+        None if none of them applies
+        """
+        angle = random.uniform(-self.rotate_limit, self.rotate_limit) if random.random() < self.random_rotate_p else 0
+        fx = -1 if random.random() < self.horizontal_flip_p else 1
+        fy = -1 if random.random() < self.vertical_flip_p else 1
+        if angle == 0 and fx == 1 and fy == 1:
+            return None
+        height, width = self.img_size
+        center = ((width - 1) / 2, (height - 1) / 2)  # pixel centre, as used by A.Rotate
+        matrix = cv2.getRotationMatrix2D(center, angle, 1.0)
+        # mirror the rotated coordinates about the centre
+        matrix[0] *= fx
+        matrix[0, 2] += (1 - fx) * center[0]
+        matrix[1] *= fy
+        matrix[1, 2] += (1 - fy) * center[1]
+        return matrix
+
+    def random_brightness_contrast(self, img):
+        """Random brightness and contrast change of a uint8 image, applied in place through a 256 entry lookup table"""
+        if random.random() >= self.augmentation_p:
+            return img
+        alpha = 1 + random.uniform(-self.contrast_limit, self.contrast_limit) if random.random() < self.contrast_p else 1
+        beta = 255 * random.uniform(-self.brightness_limit, self.brightness_limit) \
+            if random.random() < self.brightness_p else 0
+        if alpha == 1 and beta == 0:
+            return img
+        lut = np.clip(np.arange(256) * alpha + beta, 0, 255).astype(np.uint8)
+        return cv2.LUT(img, lut, dst=img)
 
 
 ################################################################################
-def load_nii_file(fpath):
-    arr = nib.load(fpath)
+def load_nii_file(fpath, out=None):
+    # uncompressed files are memory-mapped and stay on disk until sliced, .nii.gz files are decompressed here
+    arr = nib.load(fpath, mmap=True)
     arr = np.asanyarray(arr.dataobj)
     if len(arr.shape) == 2:
         arr = arr[..., None]
+    # NIfTI data is stored in Fortran order, the swapped axes are a C-contiguous view and need no copy
     arr = np.swapaxes(arr, 0, 2)
+    if out is not None:  # e.g. a memory-mapped cache file, written without an intermediate array
+        out[...] = arr
+        return out
     return arr
 
 
+def nii_volume_shape(fpath) -> Tuple[int, int, int]:
+    """Shape of the volume returned by load_nii_file, read from the header only"""
+    shape = nib.load(fpath).shape
+    if len(shape) == 2:
+        shape = (*shape, 1)
+    return shape[2], shape[1], shape[0]
+
+
 
 ################################################################################
-def reg_data_prep(img_list: List[str], mask_list: List[str]) -> Tuple[np.ndarray, np.ndarray]:
-    data = Parallel(n_jobs=5)(
-        delayed(read_data)(img_path, mask_path) for img_path, mask_path in zip(img_list, mask_list))
-    img_data_set, mask_data_set = list(zip(*data))
-    mask_data_set = np.concatenate(mask_data_set, axis=0)
-    img_data_set = np.concatenate(img_data_set, axis=0)
-    return img_data_set, mask_data_set
-
-
-def read_data(img_path, mask_path):
-    img_data = load_nii_file(img_path)
-    mask_data = load_nii_file(mask_path)
-    mask_data = np.expand_dims(mask_data, axis=3).astype(np.int8)
-    img_data = np.expand_dims(img_data, axis=3)
-    return img_data, mask_data
\ No newline at end of file
+def reg_data_prep(img_list: List[str], mask_list: List[str],
+                  img_size: Tuple[int, int]) -> Tuple[List[np.ndarray], List[np.ndarray], np.ndarray]:
+    """
+    Loads all volumes without concatenating them into one array, which would copy the whole dataset.
+    Returns the uint8 image and mask volumes of shape (depth, *img_size, 1) and an index of (volume, slice) pairs.
+    """
+    # threads instead of processes: nibabel releases the GIL while decompressing and reading, and the volumes are
+    # not pickled back from worker processes
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        data = list(executor.map(read_data, img_list, mask_list, repeat(img_size)))
+    img_volumes, mask_volumes = (list(volumes) for volumes in zip(*data))
+    return img_volumes, mask_volumes, build_slice_index(img_volumes)
+
+
+def build_slice_index(volumes: List[np.ndarray]) -> np.ndarray:
+    return np.array([(case, z) for case, volume in enumerate(volumes) for z in range(len(volume))],
+                    dtype=np.int64).reshape(-1, 2)
+
+
+def cache_paths(img_path: str, cache_dir: str) -> Tuple[str, str]:
+    name = os.path.basename(img_path)
+    for suffix in ('.nii.gz', '.nii'):  # only the extension, file names may contain further dots
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    return os.path.join(cache_dir, f"{name}_img.npy"), os.path.join(cache_dir, f"{name}_mask.npy")
+
+
+def prepare_cache(img_list: List[str], mask_list: List[str], cache_dir: str, img_size: Tuple[int, int]):
+    """
+    Decodes every NIfTI pair once and stores it resized to img_size as uncompressed .npy files in cache_dir, so
+    later runs memory-map the volumes instead of decompressing the .nii.gz files again. Existing cache files of the
+    same image size are kept.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(cache_pair, img_list, mask_list, repeat(cache_dir), repeat(img_size)))
+
+
+def cache_pair(img_path: str, mask_path: str, cache_dir: str, img_size: Tuple[int, int]):
+    img_cache, mask_cache = cache_paths(img_path, cache_dir)
+    if is_cached(img_path, mask_path, img_cache, mask_cache, img_size):
+        return
+    write_cache(img_cache, load_image, img_path, img_size)
+    write_cache(mask_cache, load_mask, mask_path, img_size)
+
+
+def is_cached(img_path: str, mask_path: str, img_cache: str, mask_cache: str, img_size: Tuple[int, int]) -> bool:
+    """
+    Whether both cache files exist as uint8 volumes of img_size and are newer than their NIfTI files. Float, differently
+    resized or outdated caches (e.g. of a corrected label file) are rebuilt.
+    """
+    for source, cache_file in ((img_path, img_cache), (mask_path, mask_cache)):
+        if not os.path.isfile(cache_file) or os.path.getmtime(cache_file) < os.path.getmtime(source):
+            return False
+    try:
+        img, mask = np.load(img_cache, mmap_mode='r'), np.load(mask_cache, mmap_mode='r')
+    except ValueError:  # unreadable header
+        return False
+    return img.dtype == mask.dtype == np.uint8 and img.shape == mask.shape and img.shape[1:] == (*img_size, 1)
+
+
+def write_cache(cache_file: str, load, fpath: str, img_size: Tuple[int, int]):
+    """
+    Loads a volume straight into a memory-mapped .npy file. The file is filled under a temporary name and only moved
+    to cache_file once complete, so an interrupted build never leaves a cache file that passes is_cached.
+    """
+    tmp_file = f"{cache_file}.tmp"
+    out = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.uint8, shape=data_shape(fpath, img_size))
+    load(fpath, img_size, out=out[..., 0])
+    out.flush()
+    del out
+    os.replace(tmp_file, cache_file)
+
+
+def load_cache(img_list: List[str], mask_list: List[str], cache_dir: str,
+               img_size: Tuple[int, int]) -> Tuple[List[np.ndarray], List[np.ndarray], np.ndarray]:
+    """Same as reg_data_prep, but with volumes memory-mapped from the cache (built on first use)"""
+    prepare_cache(img_list, mask_list, cache_dir, img_size)
+    img_volumes, mask_volumes = [], []
+    for img_path in img_list:
+        img_cache, mask_cache = cache_paths(img_path, cache_dir)
+        img_volumes.append(np.load(img_cache, mmap_mode='r'))
+        mask_volumes.append(np.load(mask_cache, mmap_mode='r'))
+    return img_volumes, mask_volumes, build_slice_index(img_volumes)
+
+
+def read_data(img_path, mask_path, img_size):
+    # written once, in their final layout
+    img_data = np.empty(data_shape(img_path, img_size), dtype=np.uint8)
+    load_image(img_path, img_size, out=img_data[..., 0])
+    mask_data = np.empty(data_shape(mask_path, img_size), dtype=np.uint8)
+    load_mask(mask_path, img_size, out=mask_data[..., 0])
+    return img_data, mask_data
+
+
+def data_shape(fpath, img_size) -> Tuple[int, int, int, int]:
+    """Shape (depth, *img_size, 1) of a loaded volume"""
+    return nii_volume_shape(fpath)[0], *img_size, 1
+
+
+def load_image(img_path, img_size, out):
+    """Loads an image volume into out, min-max scaled to uint8 and with every slice resized to img_size"""
+    volume = load_nii_file(img_path)
+    if volume.shape[1:] == tuple(img_size):
+        return to_uint8(volume, out=out)
+    return resize_volume(to_uint8(volume), img_size, cv2.INTER_AREA, out=out)
+
+
+def load_mask(mask_path, img_size, out):
+    """Loads a mask volume into out as uint8, with every slice resized to img_size"""
+    if nii_volume_shape(mask_path)[1:] == tuple(img_size):
+        return load_nii_file(mask_path, out=out)
+    return resize_volume(load_nii_file(mask_path).astype(np.uint8, copy=False), img_size, cv2.INTER_NEAREST, out=out)
+
+
+def resize_volume(volume: np.ndarray, img_size, interpolation: int, out: np.ndarray) -> np.ndarray:
+    height, width = img_size
+    for z in range(len(volume)):
+        out[z] = cv2.resize(volume[z], (width, height), interpolation=interpolation)
+    return out
+
+
+def to_uint8(volume: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """Min-max scales a volume to [0, 255] and stores it as uint8, slice by slice to avoid a float copy of it"""
+    # range and offsets in floating point, integer volumes with a wide range would overflow in their own dtype
+    v_min, v_max = float(volume.min()), float(volume.max())
+    scale = 255 / (v_max - v_min) if v_max > v_min else 0
+    if out is None:
+        out = np.empty(volume.shape, dtype=np.uint8)
+    for z in range(len(volume)):
+        scaled = np.subtract(volume[z], v_min, dtype=np.float64)
+        scaled *= scale
+        np.rint(scaled, out=out[z], casting='unsafe')  # rounded, a plain cast would truncate
+    return out
\ No newline at end of file
@@ -8,6 +8,7 @@ from deep_utils import DirUtils, NIBUtils
 from tensorflow.keras.models import load_model
 
 from configs import *
+from data_preprocessing import to_uint8
 from metrics import dice_score_tf, dice_score_np, specificity_and_sensitivity
 
 
@@ -48,7 +49,7 @@ if __name__ == '__main__':
         affinemat = img.affine
         # loadtest = np.swapaxes(loadtest, 0, 2)
         # loadtest = np.expand_dims(loadtest, axis=3)
-        loadtest = load_nii_file(file_path)
+        loadtest = to_uint8(load_nii_file(file_path))  # same per-volume scaling as in training
         print("data shape:", loadtest.shape)
 
         segmentation_array = np.zeros((loadtest.shape[2], loadtest.shape[1], loadtest.shape[0]))
@@ -25,13 +25,18 @@ if __name__ == '__main__':
     val_img_files, val_mask_files = DirUtils.list_dir_full_path(ds_val_path), DirUtils.list_dir_full_path(ds_val_seg_path)
 
     print(f"[INFO] Loading Datasets")
-    val_dataset = DataGenerator(val_img_files, val_mask_files, BATCH_SIZE, IMG_SIZE, N_CHANNELS, augmentation_p=0)
+    val_dataset = DataGenerator(val_img_files, val_mask_files, BATCH_SIZE, IMG_SIZE, N_CHANNELS, augmentation_p=0,
+                                shuffle=False, cache_dir=ds_val_cache_path)
     train_dataset = DataGenerator(train_img_files, train_mask_files, BATCH_SIZE, IMG_SIZE, N_CHANNELS,
-                                  augmentation_p=0.6)
+                                  augmentation_p=0.6, shuffle_block_size=SHUFFLE_BLOCK_SIZE,
+                                  cache_dir=ds_train_cache_path)
     print(f"[INFO] Training on {len(train_img_files)} and validating on {len(val_img_files)}")
-    history = model.fit(train_dataset,
+    # the tf.data pipelines are not Sequences, hence reshuffle the training data through a callback
+    my_callbacks.append(
+        tf.keras.callbacks.LambdaCallback(on_epoch_end=lambda epoch, logs: train_dataset.on_epoch_end()))
+    history = model.fit(train_dataset.to_dataset(),
                         epochs=EPOCHS,
-                        validation_data=val_dataset,
+                        validation_data=val_dataset.to_dataset(),
                         # verbose=1,
                         callbacks=my_callbacks
                         )
@@ -41,6 +46,7 @@ if __name__ == '__main__':
     print("[INFO] Evaluating the model: ")
     test_img_files, test_mask_files = DirUtils.list_dir_full_path(ds_test_path), DirUtils.list_dir_full_path(
         ds_test_seg_path)
-    test_dataset = DataGenerator(test_img_files, test_mask_files, BATCH_SIZE, IMG_SIZE, N_CHANNELS, augmentation_p=0)
-    model.evaluate(test_dataset)
+    test_dataset = DataGenerator(test_img_files, test_mask_files, BATCH_SIZE, IMG_SIZE, N_CHANNELS, augmentation_p=0,
+                                 shuffle=False, cache_dir=ds_test_cache_path)
+    model.evaluate(test_dataset.to_dataset())
 